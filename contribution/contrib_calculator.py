@@ -18,7 +18,7 @@ class ContribCalculator(object):
     presented in http://www.dlib.org/dlib/november14/knoth/11knoth.html.
     """
 
-    def __init__(self, distances=None):
+    def __init__(self, distances=None, docs=None, n_jobs=1, cache_dir=None):
         """
         Constructor sets up logging and initialises DistCalculator class for
         calculating semantic distance between documents. To speed up
@@ -26,97 +26,172 @@ class ContribCalculator(object):
         pre-calculated distances.
         :param distances: map of document distances in the format
                           {index1: {index2: distance}}
+        :param docs: map in the format {index: document_text}, if passed
+                     the distance calculator is fitted on the documents
+                     straight away
+        :param n_jobs: number of threads used for calculating distances,
+                       -1 means using all processors, default is 1
+        :param cache_dir: directory for caching TFIDF vectors of fitted
+                          corpora, default is None (no caching)
         """
         self.logger = logging.getLogger(__name__)
-        self.dist_calculator = DistCalculator()
-        self.calculated_distances = distances if distances is not None else {}
+        self.dist_calculator = DistCalculator(n_jobs=n_jobs,
+                                              cache_dir=cache_dir)
+        self._distances = distances if distances is not None else {}
+        # distances between the fitted documents, indexed by their rows in
+        # the TFIDF matrix, numpy.nan marks distances not calculated yet
+        self._dist = None
+        # mean distances keyed by the pair of document sets
+        self._mean_cache = {}
+        self._docs = None
+        if docs is not None:
+            self.fit(docs)
+
+    def fit(self, docs):
+        """
+        Fit the distance calculator on the documents, which processes all the
+        texts once before any distances are calculated. Distances calculated
+        on previously fitted documents are dropped, since they depend on
+        the whole corpus, only the pre-calculated distances passed to
+        the constructor are kept.
+        :param docs: map in the format {index: document_text}
+        :return: None
+        """
+        self.dist_calculator.fit(docs)
+        # a copy is kept, so that documents added to or changed in docs
+        # after fitting are noticed
+        self._docs = dict(docs)
+        self._mean_cache = {}
+        indices = self.dist_calculator.get_indices()
+        idx_to_row = dict((idx, row) for row, idx in enumerate(indices))
+        self._dist = numpy.full((len(indices), len(indices)), numpy.nan,
+                                dtype=numpy.float32)
+        for idx1, row_distances in self._distances.items():
+            if idx1 not in idx_to_row:
+                continue
+            for idx2, distance in row_distances.items():
+                if idx2 in idx_to_row:
+                    self._dist[idx_to_row[idx1], idx_to_row[idx2]] = distance
 
     def get_calculated_distances(self):
         """
         :return: map in the format {index1: {index2: distance}}
         """
-        return self.calculated_distances
+        if self._dist is None:
+            return self._distances
+        indices = self.dist_calculator.get_indices()
+        distances = {}
+        for row1, row2 in zip(*numpy.nonzero(~numpy.isnan(self._dist))):
+            if row1 != row2:
+                distances.setdefault(indices[row1], {})[indices[row2]] = \
+                    float(self._dist[row1, row2])
+        return distances
 
-    def _get_document_text(self, doc_map, idx):
+    def _add_distances(self, rows_a, rows_b, distances):
         """
-        Retrieve document text from doc_map, return empty string in case
-        idx does not exist in the map or in case the text is empty.
-        :param doc_map: map in the format {index: document_text}
-        :param idx: index of the document text to be retrieved
-        :return: string
+        Add distances between documents in rows_a and rows_b to the matrix of
+        calculated distances. Distances which were already calculated are
+        kept.
+        :param rows_a: numpy array with TFIDF matrix rows of documents
+        :param rows_b: numpy array with TFIDF matrix rows of documents
+        :param distances: numpy array of shape (len(rows_a), len(rows_b))
+        :return: None
         """
-        if idx not in doc_map:
-            return ''
-        doc_text = doc_map[idx]
-        return '' if doc_text is numpy.nan or doc_text is None else doc_text
+        calculated = self._dist[numpy.ix_(rows_a, rows_b)]
+        missing = numpy.isnan(calculated)
+        calculated[missing] = distances[missing]
+        self._dist[numpy.ix_(rows_a, rows_b)] = calculated
+        self._dist[numpy.ix_(rows_b, rows_a)] = calculated.T
+        return
 
-    def _add_distance(self, idx1, idx2, distance):
+    def _distance(self, idx1, idx2):
         """
-        Add distance between documents idx1 and idx2 to the map of calculated
-        distances.
+        Distance between two documents, reusing it in case it was already
+        calculated.
         :param idx1: ID of document 1
         :param idx2: ID of document 2
-        :param distance: distance between the documents
-        :return: None
+        :return: distance between the documents or None in case the distance
+                 couldn't be calculated (e.g. one of the documents was empty)
         """
-        if idx1 not in self.calculated_distances:
-            self.calculated_distances[idx1] = {}
-        if idx2 not in self.calculated_distances:
-            self.calculated_distances[idx2] = {}
-        self.calculated_distances[idx1][idx2] = distance
-        self.calculated_distances[idx2][idx1] = distance
-        return
+        if idx1 == idx2:
+            self.logger.info('Identical indices, skipping')
+            return None
+        rows = self.dist_calculator.rows([idx1, idx2])
+        if len(rows) < 2:
+            return None
+        distance = self._dist[rows[0], rows[1]]
+        if numpy.isnan(distance):
+            distance = self.dist_calculator.document_distance(idx1, idx2)
+            if distance is None:
+                return None
+            self._dist[rows[0], rows[1]] = distance
+            self._dist[rows[1], rows[0]] = distance
+        return float(distance)
 
-    def _pairwise_distances(self, indices_a, indices_b, idx_text_map):
+    def _pairwise_distances(self, indices_a, indices_b):
         """
-        Takes two sets of indices and a map of the document texts and calculates
-        pairwise distances between the two sets. The result is a list with
-        the distances.
+        Takes two sets of indices and calculates pairwise distances between
+        the two sets. Only distances which weren't calculated before are
+        calculated. The result is a matrix with the distances, where pairs of
+        identical documents are set to numpy.nan. Documents which couldn't be
+        vectorized (e.g. their text was empty) are left out.
         :param indices_a: list of document indices
         :param indices_b: list of document indices
-        :param idx_text_map: map in the format {index: document_text}
-        :return: list of distances between documents in indices_a and indices_b
-        """
-        self.logger.debug('Calculating distances for indices {0} and {1}'
-                          .format(indices_a, indices_b))
-        distances = []
-        for pair in [[x, y] for x in indices_a for y in indices_b]:
-            self.logger.debug('Calculating distance for IDs {0}'.format(pair))
-            if pair[0] == pair[1]:
-                self.logger.debug('Identical indices, skipping')
-                continue
-            if pair[0] in self.calculated_distances \
-                    and pair[1] in self.calculated_distances[pair[0]]:
-                dist = self.calculated_distances[pair[0]][pair[1]]
-                self.logger.info('Reusing distance {0}'.format(dist))
-                distances.append(dist)
-            else:
-                self.logger.info('Calculating distance')
-                d1 = self._get_document_text(idx_text_map, pair[0])
-                d2 = self._get_document_text(idx_text_map, pair[1])
-                self.logger.debug('Got two abstracts, calculating distance')
-                dist = self.dist_calculator.document_distance(d1, d2)
-                if dist is not None:
-                    distances.append(dist)
-                    self._add_distance(pair[0], pair[1], dist)
+        :return: numpy array with distances between documents in indices_a
+                 and indices_b
+        """
+        self.logger.debug('Calculating distances for indices %s and %s',
+                          indices_a, indices_b)
+        rows_a = self.dist_calculator.rows(indices_a)
+        rows_b = self.dist_calculator.rows(indices_b)
+        missing = numpy.isnan(self._dist[numpy.ix_(rows_a, rows_b)])
+        if missing.any():
+            missing_a = rows_a[missing.any(axis=1)]
+            missing_b = rows_b[missing.any(axis=0)]
+            self.logger.info('Calculating %s distances',
+                             missing_a.size * missing_b.size)
+            self._add_distances(missing_a, missing_b,
+                                self.dist_calculator.distance_matrix(
+                                    missing_a, missing_b))
+        distances = self._dist[numpy.ix_(rows_a, rows_b)]
+        if indices_a is indices_b:
+            # contribution() lists every document once, so identical pairs
+            # are only on the diagonal
+            numpy.fill_diagonal(distances, numpy.nan)
+        else:
+            distances[rows_a[:, numpy.newaxis] == rows_b] = numpy.nan
         self.logger.debug('Done calculating distances, returning')
         return distances
 
-    def _mean_distance(self, indices_a, indices_b, docs):
+    def _mean_distance(self, indices_a, indices_b):
         """
+        Calculates mean distance between documents in indices_a and indices_b.
+        The result is cached for each pair of document sets, as citing and
+        cited sets of different publications often overlap.
         :param indices_a:
         :param indices_b:
-        :param docs:
         :return:
         """
-        distances = self._pairwise_distances(indices_a, indices_b, docs)
-        if len(distances) == 0:
+        key = (frozenset(indices_a), frozenset(indices_b))
+        if key in self._mean_cache:
+            self.logger.info('Reusing mean distance')
+            return self._mean_cache[key]
+        distances = self._pairwise_distances(indices_a, indices_b)
+        if indices_a is indices_b:
+            # distances within one set are symmetric, each distinct pair is
+            # once in the upper triangle
+            distances = distances[numpy.triu_indices(distances.shape[0], k=1)]
+        distances = distances[~numpy.isnan(distances)]
+        if distances.size == 0:
             self.logger.warn('Could not calculate distances')
-            return None
+            mean_distance = None
         else:
-            mean_distance = sum(distances) / len(distances)
-            self.logger.info('Mean distance is {0}'.format(mean_distance))
-            return mean_distance
+            mean_distance = float(distances.mean())
+            self.logger.info('Mean distance is %s', mean_distance)
+        # the distances are symmetric, so the mean is the same both ways
+        self._mean_cache[key] = mean_distance
+        self._mean_cache[key[::-1]] = mean_distance
+        return mean_distance
 
     def contribution(self, indices_a, indices_b, docs):
         """
@@ -131,10 +206,25 @@ class ContribCalculator(object):
         :return: contribution value
         """
 
+        # a document listed more than once (e.g. a repeated citation) is
+        # counted once, the distance calculation relies on this
+        indices_a = list(dict.fromkeys(indices_a))
+        indices_b = list(dict.fromkeys(indices_b))
+
         if len(indices_a) == 0 or len(indices_b) == 0:
             self.logger.info('No citing or cited docs, returning None')
             return None
 
+        if docs != self._docs:
+            self.fit(docs)
+
+        if len(indices_a) == 1 and len(indices_b) == 1:
+            self.logger.info('Only one citing and cited paper, contribution '
+                             'is their distance')
+            contribution = self._distance(indices_a[0], indices_b[0])
+            self.logger.info('Done, contribution is %s', contribution)
+            return contribution
+
         if len(indices_a) == 1 or len(indices_b) == 1:
             self.logger.info('Only one citing or cited paper, setting '
                              'adjustment parameters to 1')
@@ -143,8 +233,12 @@ class ContribCalculator(object):
         else:
             self.logger.info('More than one citing and cited paper, '
                              'calculating adjustment parameters')
-            overline_a = self._mean_distance(indices_a, indices_a, docs)
-            overline_b = self._mean_distance(indices_b, indices_b, docs)
+            overline_a = self._mean_distance(indices_a, indices_a)
+            overline_b = self._mean_distance(indices_b, indices_b)
+
+        if overline_a is None or overline_b is None:
+            self.logger.warn('Could not calculate adjustment parameters')
+            return None
 
         if (overline_a <= 0 or overline_a > 1 or
                     overline_b <= 0 or overline_b > 1):
@@ -153,7 +247,11 @@ class ContribCalculator(object):
             return None
 
         self.logger.info('Calculating inter group distance')
-        mean_distance = self._mean_distance(indices_a, indices_b, docs)
+        mean_distance = self._mean_distance(indices_a, indices_b)
+
+        if mean_distance is None:
+            self.logger.warn('Could not calculate inter group distance')
+            return None
 
         if mean_distance < 0 or mean_distance > 1:
             self.logger.warn('Mean distance is out of the interval [0, 1]')
@@ -161,8 +259,8 @@ class ContribCalculator(object):
 
         self.logger.debug('Calculating contribution')
         adjust = overline_b / overline_a
-        self.logger.info('Adjusting by {0}, mean distance is {1}'
-                         .format(adjust, mean_distance))
+        self.logger.info('Adjusting by %s, mean distance is %s',
+                         adjust, mean_distance)
         contribution = adjust * mean_distance
-        self.logger.info('Done, contribution is {0}'.format(contribution))
+        self.logger.info('Done, contribution is %s', contribution)
         return contribution
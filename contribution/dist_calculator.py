@@ -1,82 +1,280 @@
 
 # standard python modules
+import hashlib
 import logging
+import os
+import re
 import string
+import tempfile
+from functools import lru_cache
 
 # installed modules
 import nltk
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy
+import scipy.sparse
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.pipeline import Pipeline
 
 
 __author__ = 'Drahomira Herrmannova'
 __email__ = 'd.herrmannova@gmail.com'
 
 
+# version of the text processing, increase it whenever normalize or
+# stemming changes, so that TFIDF vectors cached on disk are not reused
+CACHE_VERSION = 1
+
 stemmer = nltk.stem.porter.PorterStemmer()
-remove_punctuation_map = dict((ord(char), None) for char in string.punctuation)
+punctuation_pattern = re.compile('[{0}]'.format(re.escape(string.punctuation)))
+# the same words repeat many times across the corpus, each of them only
+# needs to go through the stemmer once
+stem = lru_cache(maxsize=None)(stemmer.stem)
 
 
 def stem_tokens(tokens):
-    return [stemmer.stem(item) for item in tokens]
+    return [stem(item) for item in tokens]
 
 
+# the vectorizer is fitted again for every new set of documents, which
+# usually shares most of its texts with the previous one, recently used
+# texts are therefore not tokenized and stemmed again, the cache is bounded
+# so that it doesn't keep the whole corpus in memory
+@lru_cache(maxsize=1024)
 def normalize(text):
-    return stem_tokens(nltk.word_tokenize(
-        text.lower().translate(remove_punctuation_map)))
+    return tuple(stem_tokens(nltk.word_tokenize(
+        punctuation_pattern.sub('', text).lower())))
+
+
+# tokens are hashed straight into the feature space instead of building
+# a vocabulary, the term counts are then weighted and normalised, texts are
+# already lowercased by normalize
+vectorizer = Pipeline([
+    ('counts', HashingVectorizer(tokenizer=normalize, stop_words='english',
+                                 lowercase=False, token_pattern=None,
+                                 n_features=2 ** 20, alternate_sign=False,
+                                 norm=None, dtype=numpy.float32)),
+    ('tfidf', TfidfTransformer()),
+])
+
+
+def _vectorizer_params():
+    """
+    :return: string describing the vectorizer settings, functions and types
+             are described by their names so that the string is the same in
+             every run
+    """
+    params = []
+    for name, value in sorted(vectorizer.get_params(deep=True).items()):
+        # nested estimators are described by their own parameters
+        if name == 'steps' or hasattr(value, 'get_params'):
+            continue
+        if callable(value):
+            value = getattr(value, '__qualname__', type(value).__qualname__)
+        params.append('{0}={1!r}'.format(name, value))
+    return ';'.join(params)
+
+
+def _corpus_key(indices, documents):
+    """
+    :param indices: list of document indices
+    :param documents: list of document texts
+    :return: hex digest identifying the corpus and the way it is processed
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update('{0};{1}'.format(CACHE_VERSION, _vectorizer_params())
+               .encode('utf-8'))
+    key.update(b'\0')
+    for idx, text in zip(indices, documents):
+        key.update(repr(idx).encode('utf-8'))
+        key.update(b'\0')
+        key.update(text.encode('utf-8'))
+        key.update(b'\0')
+    return key.hexdigest()
 
 
-vectorizer = TfidfVectorizer(tokenizer=normalize, stop_words='english')
+def _similarities(matrix_a, matrix_b):
+    # the weights stay in float32, scipy sparse products accumulate in the
+    # dtype of the operands, so quantized int8 weights would overflow and
+    # widening them first costs as much as the float32 product itself
+    return (matrix_a @ matrix_b).toarray()
 
 
 class DistCalculator:
     """
-    Class for calculating semantic distance of two texts. It uses NLTK library
-    for the calculation. The class has only one method, which accepts two texts
-    d1 and d2 and returns their semantic distance. The distance is calculated as
-    1-sim(d1, s2), the similarity method used is cosine similarity calculated
+    Class for calculating semantic distance of texts. It uses NLTK library
+    for the text processing. The class is first fitted on the whole corpus of
+    documents, after which the distance of any two documents in the corpus can
+    be calculated using their indices. The distance is calculated as
+    1-sim(d1, d2), the similarity method used is cosine similarity calculated
     on TFIDF document vectors.
     """
 
-    def __init__(self, log_level=logging.INFO):
+    def __init__(self, log_level=logging.INFO, n_jobs=1, cache_dir=None):
         """
-        Constructor only sets up logging
+        Constructor sets up logging, the number of parallel jobs and
+        the directory for caching TFIDF vectors
         :param log_level: default is logging.INFO
+        :param n_jobs: number of threads used for calculating distances,
+                       -1 means using all processors, default is 1
+        :param cache_dir: directory where TFIDF vectors of fitted corpora are
+                          stored and reused when the same corpus is fitted
+                          again, default is None (no caching)
         """
         self._logger = logging.getLogger(__name__)
         self._logger.setLevel(log_level)
+        self._n_jobs = n_jobs
+        self._cache_dir = cache_dir
+        self._tfidf = None
+        self._idx_to_row = {}
+        self._row_to_idx = []
 
-    def document_distance(self, d1, d2):
+    def fit(self, docs):
         """
-        :param d1: text (full-text/abstract) of document 1
-        :param d2: text (full-text/abstract) of document 2
-        :return: distance of the passed documents (value between 0 and 1) or
-                 None in case the distance couldn't be calculated (e.g. one of
-                 the documents was empty)
+        Converts all documents to TFIDF vectors in one pass, so that each text
+        is processed only once regardless of how many distances it is used in.
+        Documents which are missing a text are skipped and any distance
+        involving them will be None.
+        :param docs: map in the format {index: document_text}
+        :return: None
         """
-        self._logger.debug('Calculating distance of documents'
-                          '\n\nD1: {0}\n\nD2: {1}'.format(d1, d2))
-        if not d1 or not d2:
-            self._logger.warn('One of the texts was empty')
+        self._tfidf = None
+        self._idx_to_row = {}
+        self._row_to_idx = []
+        indices = []
+        documents = []
+        for idx, text in docs.items():
+            if text is numpy.nan or text is None or not text:
+                self._logger.warn('Text of document %s is empty', idx)
+                continue
+            indices.append(idx)
+            documents.append(text)
+        if self._cache_dir is None:
+            tfidf = self._vectorize(documents)
+        else:
+            cache_path = os.path.join(self._cache_dir, '{0}.npz'.format(
+                _corpus_key(indices, documents)))
+            if os.path.exists(cache_path):
+                self._logger.info('Loading TFIDF vectors from %s',
+                                  cache_path)
+                tfidf = scipy.sparse.load_npz(cache_path)
+            else:
+                tfidf = self._vectorize(documents)
+                if tfidf is not None:
+                    self._save(tfidf, cache_path)
+        if tfidf is None:
+            return
+        # the whole corpus is kept in three flat arrays of the CSR matrix
+        # (weights, hashed token ids and offsets of the documents), which
+        # the hashing vectorizer fills directly without per document lists
+        self._tfidf = tfidf.tocsr()
+        self._idx_to_row = dict((idx, row) for row, idx in enumerate(indices))
+        self._row_to_idx = indices
+
+    def _vectorize(self, documents):
+        """
+        :param documents: list of document texts
+        :return: sparse matrix with TFIDF vectors of the documents or None in
+                 case there are no documents
+        """
+        if not documents:
+            self._logger.warn('No documents to fit the vectorizer on')
             return None
-        documents = [d1, d2]
+        self._logger.info('Fitting vectorizer on %s documents',
+                          len(documents))
         # the method vectorizer.fit_transform will:
         # 1. remove punctuation
         # 2. tokenize the texts
         # 3. stem the tokens
         # 4. remove stop words
         # 5. convert texts to vectors
+        return vectorizer.fit_transform(documents)
+
+    def _save(self, tfidf, cache_path):
+        """
+        Store TFIDF vectors in the cache. The matrix is written to a temporary
+        file first, so that an interrupted run never leaves a partial file
+        behind.
+        :param tfidf: sparse matrix with TFIDF vectors
+        :param cache_path: path of the cache file
+        :return: None
+        """
+        os.makedirs(self._cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self._cache_dir)
+        os.close(fd)
         try:
-            tfidf = vectorizer.fit_transform(documents)
-        except ValueError:
-            self._logger.warn('Empty vocabulary')
+            scipy.sparse.save_npz(tmp_path, tfidf.tocsr())
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            self._logger.warn('Could not save TFIDF vectors to %s',
+                              cache_path)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_indices(self):
+        """
+        :return: list of indices of the fitted documents in the order of their
+                 rows in the TFIDF matrix
+        """
+        return self._row_to_idx
+
+    def rows(self, indices):
+        """
+        :param indices: list of document indices
+        :return: numpy array with TFIDF matrix rows of the documents, documents
+                 which couldn't be vectorized (e.g. their text was empty) are
+                 left out
+        """
+        rows = [self._idx_to_row[idx] for idx in indices
+                if idx in self._idx_to_row]
+        if len(rows) < len(indices):
+            self._logger.warn('Some of the texts were empty')
+        return numpy.array(rows, dtype=numpy.intp)
+
+    def distance_matrix(self, rows_a, rows_b):
+        """
+        Calculates distances between every document in rows_a and every
+        document in rows_b using a single sparse matrix product.
+        :param rows_a: numpy array with TFIDF matrix rows of documents
+        :param rows_b: numpy array with TFIDF matrix rows of documents
+        :return: numpy array of shape (len(rows_a), len(rows_b)) with
+                 the distances
+        """
+        matrix_b = self._tfidf[rows_b].T.tocsr()
+        n_jobs = min(effective_n_jobs(self._n_jobs), len(rows_a))
+        if n_jobs > 1:
+            # scipy releases the GIL in sparse matrix products, so the chunks
+            # run in parallel in threads without copying the matrices
+            chunks = Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(_similarities)(self._tfidf[chunk], matrix_b)
+                for chunk in numpy.array_split(rows_a, n_jobs))
+            similarities = numpy.vstack(chunks)
+        else:
+            similarities = _similarities(self._tfidf[rows_a], matrix_b)
+        # tf-idf vectors are normalised and non-negative, so anything outside
+        # of [0, 1] is a rounding error
+        return numpy.clip(1 - similarities, 0, 1)
+
+    def document_distance(self, idx1, idx2):
+        """
+        :param idx1: index of document 1
+        :param idx2: index of document 2
+        :return: distance of the passed documents (value between 0 and 1) or
+                 None in case the distance couldn't be calculated (e.g. one of
+                 the documents was empty)
+        """
+        self._logger.debug('Calculating distance of documents %s and %s',
+                           idx1, idx2)
+        if idx1 not in self._idx_to_row or idx2 not in self._idx_to_row:
+            self._logger.warn('One of the texts was empty')
             return None
+        row1 = self._tfidf[self._idx_to_row[idx1]]
+        row2 = self._tfidf[self._idx_to_row[idx2]]
         # no need to normalise separately, since Vectorizer returns
         # normalised tf-idf
-        pairwise_similarity = tfidf * tfidf.T
-        distance = 1 - pairwise_similarity.A[0][1]
-        self._logger.debug('Distance is {0}'.format(distance))
-        if distance < 0 or distance > 1:
-            self._logger.warn('Incorrect distance: %s', distance)
-            return None
-        else:
-            return distance
+        # tf-idf vectors are normalised and non-negative, so anything outside
+        # of [0, 1] is a rounding error
+        distance = numpy.clip(1 - row1.multiply(row2).sum(), 0, 1)
+        self._logger.debug('Distance is %s', distance)
+        return distance
@@ -1,10 +1,12 @@
 
 import os
-import csv
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from logging.config import dictConfig
 
+import numpy
+
 from contribution.contrib_calculator import ContribCalculator
 
 
@@ -34,35 +36,45 @@ def setup_logging(default_path='logging.json', default_level=logging.DEBUG):
     return
 
 
+def read_document(path):
+    """
+    Read text of a document
+    :param path: path to the document
+    :return: text of the document or None in case the file doesn't exist
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read()
+
+
 if __name__ == '__main__':
     setup_logging()
     main_logger = logging.getLogger(__name__)
 
-    documents = {}
-    indices_cited = []
-    indices_citing = []
-
     doc_id = 27 # which document are we calculating contribution for
     data_dir = 'test_data'
     citnet_file = 'citations.tsv'
 
+    main_logger.info('Loading citation network')
+    citations = numpy.loadtxt(os.path.join(data_dir, citnet_file),
+                              delimiter='\t', dtype=numpy.int32, ndmin=2)
+    if citations.size == 0:
+        # loadtxt returns shape (0, 1) for a file without any edges
+        citations = citations.reshape(0, 2)
+    indices_cited = citations[citations[:, 0] == doc_id, 1].tolist()
+    indices_citing = citations[citations[:, 1] == doc_id, 0].tolist()
+
     main_logger.info('Loading documents')
-    for file in os.listdir(data_dir):
-        if file.endswith('.txt'):
-            index = os.path.basename(file).replace('.txt', '')
-            with open(os.path.join(data_dir, file), 'r') as f:
-                documents[index] = f.read()
+    # only the documents which are part of the calculation are loaded, the
+    # files are read in parallel as reading them is I/O bound
+    indices = sorted(set(indices_cited) | set(indices_citing) | {doc_id})
+    paths = [os.path.join(data_dir, '{0}.txt'.format(index))
+             for index in indices]
+    with ThreadPoolExecutor() as executor:
+        documents = dict(zip(indices, executor.map(read_document, paths)))
 
-    main_logger.info('Loading citation network')
-    with open(os.path.join(data_dir, citnet_file),'r') as f:
-        reader = csv.reader(f, delimiter='\t')
-        for row in reader:
-            if int(row[0]) == doc_id:
-                indices_cited.append(row[1])
-            elif int(row[1]) == doc_id:
-                indices_citing.append(row[0])
-
-    contrib_calculator = ContribCalculator()
+    contrib_calculator = ContribCalculator(cache_dir='./cache/')
     contribution = contrib_calculator.contribution(indices_a=indices_cited,
                                     indices_b=indices_citing,
                                     docs=documents)